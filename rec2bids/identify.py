@@ -2,17 +2,34 @@
 Provide meta data for recording data.
 '''
 
+import functools
 import os
 import re
+import shelve
 import time
-import tobids
 
-from joblib import Memory
 from pyedfread import edfread
 from scipy.io import loadmat
 from scipy.io.matlab.miobase import MatReadError
 
-memory = Memory(cachedir='/Users/nwilming/u/flexible_rule/cache', verbose=0)
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+_ACQ_CACHE = shelve.open(os.path.expanduser('~/.rec2bids_acq_cache'),
+                         writeback=False)
+
+# Compiled once at import time; compiling per call dominates the
+# identification loop for large file sets.
+_SPB_RE = re.compile(r'S(\d+)_P(\d)_B(\d)')
+_TOKEN_RES = {}
+
+# Odd sessions are inference sessions, even ones predict sessions.
+# Built once at import instead of on every ident_behav call.
+_TASK_MAP = dict((s, dict((b, 'predict' if s % 2 == 0 else 'inference')
+                          for b in range(1, 8)))
+                 for s in range(1, 7))
 
 
 def identify_file(filename):
@@ -21,6 +38,10 @@ def identify_file(filename):
 
     Input is the absolute path of the file to be identified.
 
+    Returns an empty list if the file can not be identified;
+    raising/catching an exception per skipped file is far more
+    expensive than a plain return.
+
     Output:
         dict with fields:
             file = str
@@ -49,68 +70,203 @@ def identify_file(filename):
                 anatomical T1 image.
     '''
 
-    results = ident_behav(filename)
-    if results is None:
-        raise tobids.Skip(filename)
-    return results
+    return ident_behav(filename)
 
 
 def ident_behav(filename):
     '''
     Identify a file from the immuno experiment.
+
+    Returns an empty list for files that do not belong to the
+    experiment.
     '''
-    task_map = {1: dict((i, 'inference') for i in range(1, 8)),
-                2: dict((i, 'predict') for i in range(1, 8)),
-                3: dict((i, 'inference') for i in range(1, 8)),
-                4: dict((i, 'predict') for i in range(1, 8)),
-                5: dict((i, 'inference') for i in range(1, 8)),
-                6: dict((i, 'predict') for i in range(1, 8))}
-    p = re.compile('S\d+_P\d_B\d')
-    if (p.search(filename) and
-            (filename.lower().endswith('mat')
-                or filename.lower().endswith('edf'))):
-        ftype_mapping = {'mat': 'func', 'edf': 'func'}
-
-        fileend = filename.split('/')[-1]
-        parts = fileend.split('_')
-        subject = int(parts[0][1:])
-        session = int(parts[1][1:])
-        block = int(parts[2][1:])
-        file_format = parts[-1].split('.')[-1]
-        data_type = ftype_mapping[file_format]
-        return {'file': filename,
-                'subject': '%02i' % subject,
-                'session': '%02i' % session,
-                'run': '%02i' % block,
-                'data_type': data_type,
-                'task': task_map[session][block],
-                'file_format': file_format,
-                'modality': {'mat': 'stim', 'edf': 'physio'}[file_format]}
+    # Cheap extension test first; only lowercase the tail instead of
+    # the whole path and skip the regex for non-matching formats.
+    file_format = filename.rpartition('.')[2].lower()
+    if file_format not in ('mat', 'edf'):
+        return []
+    m = _SPB_RE.search(filename)
+    if m is None:
+        return []
+    subject, session, block = map(int, m.groups())
+    return {'file': filename,
+            'subject': '%02i' % subject,
+            'session': '%02i' % session,
+            'run': '%02i' % block,
+            'data_type': 'func',
+            'task': _TASK_MAP[session][block],
+            'file_format': file_format,
+            'modality': {'mat': 'stim', 'edf': 'physio'}[file_format]}
+
+
+def ident_behav_batch(filenames):
+    '''
+    Batched version of ident_behav for a whole file list.
+
+    Pulls subject, session and block out of all basenames in one
+    batched pass instead of one regex search per file. Parsing runs
+    through a numba-jitted byte loop when numba is installed and
+    through a vectorized pandas regex otherwise. Returns a list of
+    dicts suitable for BIDSTemplate.identify_batch.
+    '''
+    filenames = list(filenames)
+    basenames = [os.path.basename(f) for f in filenames]
+    if njit is None:
+        parsed = _parse_basenames(basenames)
+    else:
+        parsed = _parse_basenames_jit(basenames)
+    results = []
+    for i, subject, session, block, file_format in parsed:
+        results.append({'file': filenames[i],
+                        'subject': '%02i' % subject,
+                        'session': '%02i' % session,
+                        'run': '%02i' % block,
+                        'data_type': 'func',
+                        'task': _TASK_MAP[session][block],
+                        'file_format': file_format,
+                        'modality': {'mat': 'stim',
+                                     'edf': 'physio'}[file_format]})
+    return results
+
+
+def _parse_basenames(basenames):
+    '''
+    Parse basenames with one vectorized regex pass over all names.
+    '''
+    import pandas as pd
+    # Only the extension is case-insensitive; the S/P/B part must
+    # match _SPB_RE, which is case-sensitive.
+    df = pd.Series(basenames).str.extract(
+        r'S(\d+)_P(\d)_B(\d).*\.((?i:mat|edf))$')
+    df.columns = ['subject', 'session', 'block', 'file_format']
+    return [(row.Index, int(row.subject), int(row.session),
+             int(row.block), row.file_format.lower())
+            for row in df.dropna().itertuples()]
+
+
+def _parse_basenames_jit(basenames):
+    '''
+    Parse basenames with a numba-compiled loop over their bytes.
+
+    Names are packed into a padded uint8 matrix so parsing stays in
+    the integer domain; numba handles str objects poorly but byte
+    arrays well. Case handling mirrors _parse_basenames: the S/P/B
+    part is case-sensitive, only the extension is not.
+    '''
+    import numpy as np
+    lengths = np.array([len(b) for b in basenames], dtype=np.int64)
+    buf = np.zeros((len(basenames), int(lengths.max(initial=0))),
+                   dtype=np.uint8)
+    for i, b in enumerate(basenames):
+        buf[i, :lengths[i]] = np.frombuffer(
+            b.encode('ascii', 'replace'), dtype=np.uint8)
+    subject = np.empty(len(basenames), dtype=np.int64)
+    session = np.empty_like(subject)
+    block = np.empty_like(subject)
+    ext = np.empty_like(subject)
+    _parse_spb(buf, lengths, subject, session, block, ext)
+    formats = {1: 'mat', 2: 'edf'}
+    return [(i, subject[i], session[i], block[i], formats[ext[i]])
+            for i in range(len(basenames))
+            if subject[i] >= 0 and ext[i] > 0]
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _parse_spb(buf, lengths, subject, session, block, ext):
+        # Scans each row for 'S<digits>_P<digit>_B<digit>' and a
+        # trailing '.mat'/'.edf'; ASCII codes keep numba in nopython
+        # mode ('S'=83, 'P'=80, 'B'=66, '_'=95, '.'=46).
+        for i in prange(buf.shape[0]):
+            subject[i] = -1
+            n = lengths[i]
+            for j in range(n):
+                if buf[i, j] != 83:
+                    continue
+                k = j + 1
+                num = 0
+                while k < n and 48 <= buf[i, k] <= 57:
+                    num = num * 10 + (buf[i, k] - 48)
+                    k += 1
+                if (k > j + 1 and k + 5 < n and buf[i, k] == 95
+                        and buf[i, k + 1] == 80
+                        and 48 <= buf[i, k + 2] <= 57
+                        and buf[i, k + 3] == 95
+                        and buf[i, k + 4] == 66
+                        and 48 <= buf[i, k + 5] <= 57):
+                    subject[i] = num
+                    session[i] = buf[i, k + 2] - 48
+                    block[i] = buf[i, k + 5] - 48
+                    break
+            ext[i] = 0
+            if n >= 4 and buf[i, n - 4] == 46:
+                a = buf[i, n - 3] | 32
+                b = buf[i, n - 2] | 32
+                c = buf[i, n - 1] | 32
+                if a == 109 and b == 97 and c == 116:
+                    ext[i] = 1
+                elif a == 101 and b == 100 and c == 102:
+                    ext[i] = 2
 
 
 def parse(string, tokens):
     '''
     Extract all numbers following token.
     '''
+    for t in tokens:
+        if t not in _TOKEN_RES:
+            _TOKEN_RES[t] = re.compile(t + '\d+')
     numbers = dict((t, [int(n.replace(t, ''))
-                        for n in re.findall(t + '\d+', string)])
+                        for n in _TOKEN_RES[t].findall(string)])
                    for t in tokens)
     return numbers
 
 
-@memory.cache
+def _disk_cached(func):
+    '''
+    Cache func(filename) in memory and on disk.
+
+    The disk shelve is keyed by path, mtime and size and survives
+    across runs; much cheaper on hits than joblib.Memory, which does
+    argument hashing plus a metadata read. An lru_cache layer on top
+    of it serves repeated queries within one run (identify and sort
+    both ask for acquisition times) without touching the shelve.
+    '''
+    @functools.lru_cache(maxsize=100000)
+    def from_disk(filename, mtime):
+        key = '%s:%s:%s' % (filename, mtime, os.path.getsize(filename))
+        if key not in _ACQ_CACHE:
+            _ACQ_CACHE[key] = func(filename)
+        return _ACQ_CACHE[key]
+
+    def cached(filename):
+        return from_disk(filename, os.path.getmtime(filename))
+    return cached
+
+
+@_disk_cached
 def get_mat_p(filename):
-    return loadmat(filename)['p']['start_time'][0, 0][0]
+    try:
+        # variable_names makes scipy skip everything but 'p' instead
+        # of reading the whole recording to fetch a timestamp.
+        data = loadmat(filename, variable_names=['p'])
+        return data['p']['start_time'][0, 0][0]
+    except NotImplementedError:
+        # v7.3 mat files are HDF5 containers that loadmat rejects.
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            # Matlab stores char arrays as uint16.
+            return f['p']['start_time'][()].tobytes().decode('utf-16-le')
 
 
-@memory.cache
+@_disk_cached
 def get_edf_p(filename):
     return edfread.read_preamble(filename).decode(
         'utf-8').split('\n')[0]
 
 
 def get_acquisition_time(filename):
-    fformat = filename.split('.')[-1]
+    fformat = os.path.splitext(filename)[1][1:].lower()
     if fformat == 'mat':
         try:
             p = get_mat_p(filename)
@@ -5,19 +5,15 @@ from glob import glob
 from os.path import join
 import os
 from os import makedirs
-from subprocess import call, check_output
+from subprocess import call
 import json
 import logging
-from shutil import copy
-import collections
+from shutil import copyfile
 from tqdm import tqdm
 
 log = logging.getLogger(__name__)
 log.setLevel(-10)
 
-from joblib import Memory
-memory = Memory(cachedir='/Users/nwilming/u/flexible_rule/cache', verbose=0)
-
 
 class Skip(Exception):
     pass
@@ -82,24 +78,70 @@ class BIDSTemplate(object):
             Force new conversion of dicom dirs even if path already exists.
         '''
         self.path = path
-        self.files = list(walk(path))
-        print('Found %i files in %s' % (len(self.files), path))
-
         if convert_dicom:
-            self.ds = DicomSet(self.files, convert_dir=convert_dicom,
+            files = list(walk(path))
+            print('Found %i files in %s' % (len(files), path))
+            self.ds = DicomSet(files, convert_dir=convert_dicom,
                                force=force_dicom)
             self.files = self.ds.convert()
-        depth = 6
-        if session:
-            depth = 7
-        self.mapping = ddict(depth)
+        else:
+            # Stream the walk. identify makes a single pass over the
+            # files, so there is no need to hold every path in memory.
+            self.files = walk(path)
+        self.mapping = {}
+        self._seen = {}
         self.multi_file = []
 
     def process(self, ident_func, sort_func, target, protect=False):
+        '''
+        Identify, order, name and copy all files in one pass.
+
+        Identification streams directly off the file walk. Each
+        bucket is then ordered, named and handed to the copy pool in
+        a single loop instead of re-walking all buckets once per
+        stage; acquisition times are only fetched for buckets that
+        hold more than one entry, and copies overlap with the naming
+        of later buckets. identify/sort/generate_filenames/move are
+        still available for running the stages individually.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        if not protect:
+            protect = []
         self.identify(ident_func)
-        self.sort(sort_func)
-        self.generate_filenames()
-        self.move(target, protect=protect)
+        made_dirs = set()
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            jobs = []
+            for mf in tqdm(self.multi_file):
+                if len(mf) > 1:
+                    times = list(ex.map(sort_func,
+                                        [m['source'] for m in mf]))
+                    idx = sorted(range(len(mf)),
+                                 key=times.__getitem__)
+                    mf[:] = [mf[i] for i in idx]
+                    for m in mf:
+                        m['params']['order'] = None
+                # All entries of a multi-entry bucket share one
+                # target name (order stays None), so dedupe by target
+                # before submitting; keeping the last time-sorted
+                # source matches the old serial overwrite and stops
+                # threads racing for the same destination.
+                to_copy = {}
+                for m in mf:
+                    m['target'] = self.to_bids_filename(**m['params'])
+                    source = m['source']
+                    tgt = joinpath(target, m['target'])
+                    if (os.path.exists(tgt) and any([source.endswith(p)
+                                                     for p in protect])):
+                        continue
+                    to_copy[tgt] = source
+                for tgt, source in to_copy.items():
+                    d = os.path.dirname(tgt)
+                    if d not in made_dirs:
+                        makedirs(d, exist_ok=True)
+                        made_dirs.add(d)
+                    jobs.append(ex.submit(copyfile, source, tgt))
+            for job in jobs:
+                job.result()
 
     def identify(self, func):
         '''
@@ -108,16 +150,39 @@ class BIDSTemplate(object):
         '''
         for file in tqdm(self.files):
             try:
-
                 files = func(file)
-                if type(files) == dict:
-                    self.add(**files)
-                else:
-                    for f in files:
-                        self.add(**f)
             except Skip:
+                # Deprecated: identification functions should return
+                # an empty list for unknown files instead of raising,
+                # which is much cheaper in this loop.
+                continue
+            if not files:
                 continue
-        return json.dumps(self.mapping, indent=2)
+            if isinstance(files, dict):
+                files = [files]
+            for f in files:
+                self.add(**f)
+        return self._dump_mapping()
+
+    def identify_batch(self, func):
+        '''
+        Identify all files with a single call to a batched
+        identification function.
+
+        func receives the complete list of filenames and returns a
+        list of dicts with the same fields as the per-file
+        identification functions. This avoids the per-file Python
+        overhead of identify for large file sets.
+        '''
+        for entry in func(self.files):
+            self.add(**entry)
+        return self._dump_mapping()
+
+    def _dump_mapping(self):
+        return json.dumps(
+            dict(('/'.join(str(k) for k in key), entries)
+                 for key, entries in self.mapping.items()),
+            indent=2)
 
     def add(self, file=None, subject=None, session=None,
             run=None, data_type=None, task=None, acq=None,
@@ -137,24 +202,36 @@ class BIDSTemplate(object):
                           'file_format': file_format,
                           'modality': modality}
                       }
-        if len(self.mapping[subject][session][run][
-               data_type][file_format][modality]) > 0:
-            # Prevent duplicates
-            if any([next_entry == entry for entry in self.mapping[subject][
-                    session][run][data_type][file_format][modality]]):
-                return
-            self.mapping[subject][session][run][
-                data_type][file_format][modality].append(next_entry)
-        else:
+        key = (subject, session, run, data_type, file_format, modality)
+        # Prevent duplicates with a per-bucket set instead of
+        # comparing against every previous entry.
+        entry_key = (file, task, acq)
+        seen = self._seen.setdefault(key, set())
+        if entry_key in seen:
+            return
+        seen.add(entry_key)
+        existing = self.mapping.get(key)
+        if existing is None:
             new_list = [next_entry]
-            self.mapping[subject][session][run][
-                data_type][file_format][modality] = new_list
+            self.mapping[key] = new_list
             self.multi_file.append(new_list)
+        else:
+            existing.append(next_entry)
 
     def sort(self, get_time):
-        for mf in self.multi_file:
-            if len(mf) > 1:
-                mf.sort(key=lambda x: get_time(x['source']))
+        # get_time reads the recording from disk, so fetch the
+        # acquisition times for a bucket concurrently and sort by the
+        # pre-materialized list instead of calling get_time from
+        # inside the sort.
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=4) as ex:
+            for mf in self.multi_file:
+                if len(mf) > 1:
+                    times = list(ex.map(get_time,
+                                        [m['source'] for m in mf]))
+                    order = sorted(range(len(mf)),
+                                   key=times.__getitem__)
+                    mf[:] = [mf[i] for i in order]
 
     def generate_filenames(self, order=False):
         for mf in self.multi_file:
@@ -178,37 +255,49 @@ class BIDSTemplate(object):
         '''
         Generate BIDS compatible filename
         '''
+        shape = (session is not None, task is not None, acq is not None,
+                 run is not None, order is not None)
+        fmt = _FMT_CACHE.get(shape)
+        if fmt is None:
+            fmt = _compile_bids_formatter(shape)
+            _FMT_CACHE[shape] = fmt
+        filename = fmt(subject=subject, session=session, run=run,
+                       task=task, acq=acq, file_format=file_format,
+                       modality=modality, order=order)
         if session is None:
             path = joinpath(subject, data_type)
-            filename = subject
         else:
             path = joinpath(subject, session, data_type)
-            filename = subject + '_' + session
-        if task is not None:
-            filename += '_task-' + task
-        if acq is not None:
-            filename += '_' + acq
-        if run is not None:
-            filename += '_run-' + str(run)
-        if order is not None:
-            filename += 'ORD%02i' % order
-        filename += '_' + modality
-
-        filename += '.' + file_format
         return joinpath(path, filename)
 
     def move(self, path, protect=False):
         if not protect:
             protect = []
-        for mf in tqdm(self.multi_file):
+        # Entries of a multi-entry bucket can share one target name
+        # (generate_filenames only disambiguates with order=True).
+        # Deduplicate by target, keeping the last source like the
+        # serial overwrite did, so two copies never race for the same
+        # destination.
+        pairs = {}
+        for mf in self.multi_file:
             for m in mf:
                 source = m['source']
                 target = joinpath(path, m['target'])
                 if (os.path.exists(target) and any([source.endswith(p)
                                                     for p in protect])):
                     continue
-                makedirs(os.path.dirname(target), exist_ok=True)
-                copy(source, target)
+                pairs[target] = source
+        # Create each target directory once instead of stat'ing it
+        # again for every file it receives.
+        for d in set(os.path.dirname(target) for target in pairs):
+            makedirs(d, exist_ok=True)
+        # Copies are IO bound, so a handful of threads can overlap them.
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            jobs = [ex.submit(copyfile, source, target)
+                    for target, source in pairs.items()]
+            for job in tqdm(jobs):
+                job.result()
 
     def description(self, name, version='1.0.2', license=None,
                     authors=None, acknowledgments=None, howtoack=None,
@@ -247,22 +336,31 @@ class DicomSet(object):
         '''
         from os.path import dirname
         self.original_filenames = set(filenames)
-        self.datasets = set([dirname(f) for f in filenames])
-        if check_dicom_dir is False:
-            is_dicom_dir = lambda x: True if len(
-                get_subdirectories(x)) == 0 else False
-        self.datasets = set(
-            [f for f in tqdm(self.datasets) if is_dicom_dir(f)])
-        rm_files = [glob(join(d, '*')) for d in self.datasets]
+        candidates = set([dirname(f) for f in filenames])
+        self.datasets = set()
         self.remaining_files = self.original_filenames.copy()
-        for rm in rm_files:
-            self.remaining_files -= set(rm)
+        for d in tqdm(candidates):
+            files, has_subdir = scan_dir(d)
+            if check_dicom_dir is False:
+                dicom = not has_subdir
+            else:
+                dicom = is_dicom_dir(d)
+            if dicom:
+                self.datasets.add(d)
+                self.remaining_files -= set(files)
         self.output_dir = convert_dir
         self.force = force
 
     def convert(self):
-        for dataset in tqdm(self.datasets):
-            dicom_convert(dataset, self.output_dir, force=self.force)
+        # dcm2niix runs as a subprocess and each dataset writes to its
+        # own output dir, so the conversions can run concurrently.
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            jobs = [ex.submit(dicom_convert, dataset, self.output_dir,
+                              force=self.force)
+                    for dataset in self.datasets]
+            for job in tqdm(jobs):
+                job.result()
         json = glob(join(self.output_dir, '*/*json'))
         nifti = glob(join(self.output_dir, '*/*.nii'))
         self.converted = json, nifti
@@ -281,9 +379,60 @@ def dicom_convert(dataset, output_dir, force=False):
 
 
 def is_dicom_dir(filename):
-    ret = check_output(["file", *glob(join(filename, '*'))]).decode('utf-8')
-    ret = ret.replace(filename, '')
-    return all(['DICOM' in r for r in ret.splitlines()])
+    '''
+    Check whether a directory contains only DICOM files.
+
+    DICOM files carry the magic bytes 'DICM' at offset 128, so a
+    132 byte read per file replaces the previous fork of /usr/bin/file
+    with the directory's full content on its command line.
+    '''
+    with os.scandir(filename) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                return False
+            try:
+                with open(entry.path, 'rb') as f:
+                    f.seek(128)
+                    if f.read(4) != b'DICM':
+                        return False
+            except OSError:
+                return False
+    return True
+
+
+# One compiled formatter per combination of present filename fields.
+# There are at most 2**5 shapes, so the cache saturates immediately.
+_FMT_CACHE = {}
+
+
+def _compile_bids_formatter(shape):
+    '''
+    Compile a single f-string formatter for one filename shape.
+
+    The chain of conditional '+=' concatenations in to_bids_filename
+    allocated an intermediate string per present field; a compiled
+    f-string builds the filename in one go.
+    '''
+    has_session, has_task, has_acq, has_run, has_order = shape
+    template = '{subject}'
+    if has_session:
+        template += '_{session}'
+    if has_task:
+        template += '_task-{task}'
+    if has_acq:
+        template += '_{acq}'
+    if has_run:
+        template += '_run-{run}'
+    if has_order:
+        template += 'ORD{order:02d}'
+    template += '_{modality}.{file_format}'
+    src = ('def _fmt(subject=None, session=None, run=None, task=None,\n'
+           '         acq=None, file_format=None, modality=None,\n'
+           '         order=None):\n'
+           '    return f%r\n' % template)
+    namespace = {}
+    exec(src, namespace)
+    return namespace['_fmt']
 
 
 def joinpath(*args):
@@ -294,19 +443,31 @@ def walk(path):
     '''
     Generate all files in a dir (complete pathes).
     '''
-    for p, _, fnames in os.walk(path):
-        for ff in fnames:
-            yield os.path.join(p, ff)
-
-
-def get_subdirectories(a_dir):
-    return [name for name in os.listdir(a_dir)
-            if os.path.isdir(os.path.join(a_dir, name))]
+    stack = [path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    yield entry.path
 
 
-def ddict(n):
-    if n == 0:
-        x = lambda: {[]}
-        return x
-    else:
-        return collections.defaultdict(lambda: ddict(n - 1))
+def scan_dir(a_dir):
+    '''
+    List all files in a_dir and whether it contains subdirectories,
+    in a single scandir pass.
+    '''
+    files = []
+    has_subdir = False
+    with os.scandir(a_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                has_subdir = True
+            else:
+                files.append(entry.path)
+    return files, has_subdir